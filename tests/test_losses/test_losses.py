@@ -1,7 +1,12 @@
+import copy
+import pickle
 import pytest
 import torch
+from torch.nn import functional as F
 
-from traiNNer.losses.basic_loss import CharbonnierLoss, L1Loss, MSELoss, WeightedTVLoss
+from traiNNer.losses.basic_loss import CharbonnierLoss, ContextualLoss, L1Loss, MSELoss, WeightedTVLoss, colorloss
+from traiNNer.losses.loss_util import compile_for_cuda
+from traiNNer.utils.color_util import rgb_to_cbcr
 
 
 @pytest.mark.parametrize('loss_class', [L1Loss, MSELoss, CharbonnierLoss])
@@ -38,6 +43,54 @@ def test_pixellosses(loss_class):
         loss_class(loss_weight=1.0, reduction='unknown')
 
 
+@pytest.mark.parametrize('loss_class', [L1Loss, MSELoss, CharbonnierLoss])
+def test_pixellosses_copy(loss_class):
+    """Test loss: pixel losses stay copyable and picklable"""
+
+    pred = torch.rand((1, 3, 4, 4), dtype=torch.float32)
+    target = torch.rand((1, 3, 4, 4), dtype=torch.float32)
+    loss = loss_class(loss_weight=1.0, reduction='mean')
+
+    loss_copy = copy.deepcopy(loss)
+    loss_copy.loss_weight = 5.0
+    assert torch.allclose(loss_copy(pred, target), loss(pred, target) * 5.0)
+
+    loss_pickled = pickle.loads(pickle.dumps(loss))
+    assert torch.allclose(loss_pickled(pred, target), loss(pred, target))
+
+
+def test_compile_for_cuda_fallback(monkeypatch):
+    """Test loss util: compile_for_cuda runs eagerly where torch.compile is not supported"""
+
+    class CudaTensor(torch.Tensor):
+        # pretends to live on CUDA, so that the compile path is taken on CPU
+
+        @property
+        def is_cuda(self):
+            return True
+
+    attempts = []
+
+    def unsupported(*args, **kwargs):
+        attempts.append(args)
+        raise RuntimeError('Python 3.xx+ not yet supported for torch.compile')
+
+    calls = []
+
+    @compile_for_cuda
+    def func(x):
+        calls.append(x)
+        return x * 2
+
+    monkeypatch.setattr(torch, 'compile', unsupported)
+    x = torch.rand(3).as_subclass(CudaTensor)
+    assert torch.equal(func(x), x * 2)
+    assert torch.equal(func(x), x * 2)
+    # eager from then on, compiling is not retried
+    assert len(calls) == 2
+    assert len(attempts) == 1
+
+
 def test_weightedtvloss():
     """Test loss: WeightedTVLoss"""
 
@@ -70,3 +123,136 @@ def test_weightedtvloss():
         WeightedTVLoss(loss_weight=1.0, reduction='unknown')
     with pytest.raises(ValueError):
         WeightedTVLoss(loss_weight=1.0, reduction='none')
+
+
+@pytest.mark.parametrize('distance', ['_create_using_L1', '_create_using_L2', '_create_using_dotP'])
+def test_contextualloss_distances(distance):
+    """Test loss: ContextualLoss batched distances against a per-sample reference"""
+
+    I_features = torch.rand((2, 8, 5, 6), dtype=torch.float32)
+    T_features = torch.rand((2, 8, 5, 6), dtype=torch.float32)
+    out = getattr(ContextualLoss, distance)(I_features, T_features)
+    assert out.shape == (2, 5, 6, 30)
+
+    if distance == '_create_using_dotP':
+        mean_T = T_features.mean(dim=(0, 2, 3), keepdim=True)
+        I_features = F.normalize(I_features - mean_T, p=2, dim=1)
+        T_features = F.normalize(T_features - mean_T, p=2, dim=1)
+
+    for i in range(2):
+        Ivec = I_features[i].view(8, -1, 1)
+        Tvec = T_features[i].view(8, 1, -1)
+        if distance == '_create_using_L1':
+            ref = (Ivec - Tvec).abs().sum(dim=0)
+        elif distance == '_create_using_L2':
+            ref = ((Ivec - Tvec)**2).sum(dim=0)
+        else:
+            ref = ((1 - (Ivec * Tvec).sum(dim=0)) / 2).clamp(min=0.0)
+        assert torch.allclose(out[i].view(30, 30), ref, atol=1e-5)
+
+
+def test_contextualloss_max_sim():
+    """Test loss: ContextualLoss max similarity without the normalized similarity tensor"""
+
+    raw_distance = torch.rand((2, 5, 6, 30), dtype=torch.float32)
+    out = ContextualLoss._calculate_max_contextual_sim(raw_distance, 1.0, 0.5)
+    assert out.shape == (2, 30)
+
+    contextual_sim = ContextualLoss._calculate_contextual_sim(raw_distance, 1.0, 0.5)
+    ref = torch.max(torch.max(contextual_sim, dim=1)[0], dim=1)[0]
+    assert torch.allclose(out, ref, atol=1e-6)
+
+
+def test_contextualloss_random_pooling():
+    """Test loss: ContextualLoss random pooling indices are shared and reused"""
+
+    images = torch.rand((2, 3, 9, 9), dtype=torch.float32)
+    loss = ContextualLoss(use_vgg=False, max_1d_size=4, resample_every=3)
+
+    # images and gt are sampled at the same positions
+    images_sample, gt_sample = loss._random_pooling([images, images.clone()], output_1d_size=4)
+    assert images_sample.shape == (2, 3, 4, 4)
+    assert torch.equal(images_sample, gt_sample)
+
+    # indices are reused for resample_every forward calls, then redrawn
+    torch.manual_seed(0)
+    indices = []
+    for _ in range(4):
+        loss(images, torch.rand((2, 3, 9, 9), dtype=torch.float32))
+        indices.append(loss._sample_idx[(None, 81, images.device)])
+    assert torch.equal(indices[0], indices[1])
+    assert torch.equal(indices[1], indices[2])
+    assert not torch.equal(indices[2], indices[3])
+
+    with pytest.raises(AssertionError):
+        ContextualLoss(use_vgg=False, resample_every=0)
+
+
+def test_contextualloss_spatial_sim():
+    """Test loss: ContextualLoss cached spatial similarity of bilateral CX"""
+
+    loss = ContextualLoss(use_vgg=False, calc_type='bilateral')
+    cx_sp = loss._spatial_contextual_sim(5, 6, torch.device('cpu'))
+    assert cx_sp.shape == (1, 5, 6, 30)
+    assert loss._spatial_contextual_sim(5, 6, torch.device('cpu')) is cx_sp
+
+    # same as computing it for the whole batch from a per-sample grid
+    rows = torch.arange(0, 5, dtype=torch.float32) / 6
+    cols = torch.arange(0, 6, dtype=torch.float32) / 7
+    grid = torch.stack(torch.meshgrid(rows, cols, indexing='ij')).unsqueeze(0).repeat(2, 1, 1, 1)
+    raw_distance = ContextualLoss._create_using_L2(grid, grid)
+    ref = ContextualLoss._calculate_contextual_sim(raw_distance, loss.b, loss.band_width)
+    assert torch.allclose(cx_sp.expand_as(ref), ref)
+
+    # only the last feature size is kept
+    loss._spatial_contextual_sim(4, 4, torch.device('cpu'))
+    assert list(loss._grid_cache) == [(4, 4, torch.device('cpu'))]
+
+
+@pytest.mark.parametrize('calc_type', ['regular', 'bilateral', 'symetric'])
+def test_contextualloss_use_compile(monkeypatch, calc_type):
+    """Test loss: ContextualLoss with use_compile=False never compiles"""
+
+    class CudaTensor(torch.Tensor):
+        # pretends to live on CUDA, so that the compile path would be taken on CPU
+
+        @property
+        def is_cuda(self):
+            return True
+
+    def no_compile(*args, **kwargs):
+        raise AssertionError('torch.compile should not be called')
+
+    images = torch.rand((2, 3, 4, 4), dtype=torch.float32)
+    gt = torch.rand((2, 3, 4, 4), dtype=torch.float32)
+    loss = ContextualLoss(use_vgg=False, calc_type=calc_type, use_compile=False)
+    ref = loss(images, gt)
+
+    monkeypatch.setattr(torch, 'compile', no_compile)
+    out = loss(images.as_subclass(CudaTensor), gt.as_subclass(CudaTensor))
+    assert torch.allclose(out, ref)
+
+
+def test_contextualloss_crop_quarters():
+    """Test loss: ContextualLoss crop quarters"""
+
+    feature_tensor = torch.rand((2, 3, 6, 8), dtype=torch.float32)
+    out = ContextualLoss._crop_quarters(feature_tensor)
+
+    quarters = [
+        feature_tensor[..., :3, :4], feature_tensor[..., :3, 4:], feature_tensor[..., 3:, :4],
+        feature_tensor[..., 3:, 4:]
+    ]
+    assert torch.equal(out, torch.cat(quarters, dim=0))
+
+
+def test_colorloss_cbcr():
+    """Test loss: colorloss CbCr conversion matches rgb_to_cbcr"""
+
+    img = torch.rand((2, 3, 8, 8), dtype=torch.float32)
+    loss = colorloss(avgpool=True, scale=2)
+    assert torch.allclose(loss._to_cbcr(img), rgb_to_cbcr(img), atol=1e-6)
+
+    out = loss(img, torch.rand((2, 3, 8, 8), dtype=torch.float32))
+    assert isinstance(out, torch.Tensor)
+    assert out.shape == torch.Size([])
@@ -138,6 +138,16 @@ class VGGFeatureExtractor(nn.Module):
             # the std is for image with range [0, 1]
             self.register_buffer('std', torch.Tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
 
+        # fold range_norm and input_norm into a single x * scale + shift
+        scale = torch.ones(1, 3, 1, 1)
+        shift = torch.zeros(1, 3, 1, 1)
+        if self.range_norm:
+            scale, shift = scale * 0.5, shift + 0.5
+        if self.use_input_norm:
+            scale, shift = scale / self.std, (shift - self.mean) / self.std
+        self.register_buffer('scale', scale, persistent=False)
+        self.register_buffer('shift', shift, persistent=False)
+
     def forward(self, x):
         """Forward function.
 
@@ -147,10 +157,8 @@ class VGGFeatureExtractor(nn.Module):
         Returns:
             Tensor: Forward results.
         """
-        if self.range_norm:
-            x = (x + 1) / 2
-        if self.use_input_norm:
-            x = (x - self.mean) / self.std
+        if self.range_norm or self.use_input_norm:
+            x = torch.addcmul(self.shift, x, self.scale)
 
         output = {}
         for key, layer in self.vgg_net._modules.items():
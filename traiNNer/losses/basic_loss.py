@@ -4,7 +4,7 @@ from torch.nn import functional as F
 
 from ..archs.vgg_arch import VGGFeatureExtractor
 from ..utils.registry import LOSS_REGISTRY
-from .loss_util import weighted_loss
+from .loss_util import compile_for_cuda, weighted_loss
 from ..utils.color_util import rgb2ycbcr, ycbcr2rgb, rgb2ycbcr_pt, rgb_to_cbcr
 
 _reduction_modes = ['none', 'mean', 'sum']
@@ -25,6 +25,26 @@ def charbonnier_loss(pred, target, eps=1e-12):
     return torch.sqrt((pred - target)**2 + eps)
 
 
+def weighted_tv_loss(pred, weight=None, reduction='mean'):
+    """Total variation loss over vertical and horizontal neighbours.
+
+    Both directions are computed in one function, so when it is compiled
+    (see `WeightedTVLoss`) they are fused into a single kernel that reads
+    `pred` once.
+    """
+    if weight is None:
+        # unweighted fast path, skips the weighted_loss wrapper
+        y_diff = F.l1_loss(pred[:, :, :-1, :], pred[:, :, 1:, :], reduction=reduction)
+        x_diff = F.l1_loss(pred[:, :, :, :-1], pred[:, :, :, 1:], reduction=reduction)
+        return x_diff + y_diff
+
+    y_weight = weight[:, :, :-1, :]
+    x_weight = weight[:, :, :, :-1]
+    y_diff = l1_loss(pred[:, :, :-1, :], pred[:, :, 1:, :], y_weight, reduction=reduction)
+    x_diff = l1_loss(pred[:, :, :, :-1], pred[:, :, :, 1:], x_weight, reduction=reduction)
+    return x_diff + y_diff
+
+
 @LOSS_REGISTRY.register()
 class L1Loss(nn.Module):
     """L1 (mean absolute error, MAE) loss.
@@ -33,16 +53,19 @@ class L1Loss(nn.Module):
         loss_weight (float): Loss weight for L1 loss. Default: 1.0.
         reduction (str): Specifies the reduction to apply to the output.
             Supported choices are 'none' | 'mean' | 'sum'. Default: 'mean'.
+        use_compile (bool): If True, run forward through torch.compile on CUDA. Default: True.
     """
 
-    def __init__(self, loss_weight=1.0, reduction='mean'):
+    def __init__(self, loss_weight=1.0, reduction='mean', use_compile=True):
         super(L1Loss, self).__init__()
         if reduction not in ['none', 'mean', 'sum']:
             raise ValueError(f'Unsupported reduction mode: {reduction}. Supported ones are: {_reduction_modes}')
 
         self.loss_weight = loss_weight
         self.reduction = reduction
+        self.use_compile = use_compile
 
+    @compile_for_cuda
     def forward(self, pred, target, weight=None, **kwargs):
         """
         Args:
@@ -61,16 +84,19 @@ class MSELoss(nn.Module):
         loss_weight (float): Loss weight for MSE loss. Default: 1.0.
         reduction (str): Specifies the reduction to apply to the output.
             Supported choices are 'none' | 'mean' | 'sum'. Default: 'mean'.
+        use_compile (bool): If True, run forward through torch.compile on CUDA. Default: True.
     """
 
-    def __init__(self, loss_weight=1.0, reduction='mean'):
+    def __init__(self, loss_weight=1.0, reduction='mean', use_compile=True):
         super(MSELoss, self).__init__()
         if reduction not in ['none', 'mean', 'sum']:
             raise ValueError(f'Unsupported reduction mode: {reduction}. Supported ones are: {_reduction_modes}')
 
         self.loss_weight = loss_weight
         self.reduction = reduction
+        self.use_compile = use_compile
 
+    @compile_for_cuda
     def forward(self, pred, target, weight=None, **kwargs):
         """
         Args:
@@ -94,9 +120,10 @@ class CharbonnierLoss(nn.Module):
         reduction (str): Specifies the reduction to apply to the output.
             Supported choices are 'none' | 'mean' | 'sum'. Default: 'mean'.
         eps (float): A value used to control the curvature near zero. Default: 1e-12.
+        use_compile (bool): If True, run forward through torch.compile on CUDA. Default: True.
     """
 
-    def __init__(self, loss_weight=1.0, reduction='mean', eps=1e-12):
+    def __init__(self, loss_weight=1.0, reduction='mean', eps=1e-12, use_compile=True):
         super(CharbonnierLoss, self).__init__()
         if reduction not in ['none', 'mean', 'sum']:
             raise ValueError(f'Unsupported reduction mode: {reduction}. Supported ones are: {_reduction_modes}')
@@ -104,7 +131,9 @@ class CharbonnierLoss(nn.Module):
         self.loss_weight = loss_weight
         self.reduction = reduction
         self.eps = eps
+        self.use_compile = use_compile
 
+    @compile_for_cuda
     def forward(self, pred, target, weight=None, **kwargs):
         """
         Args:
@@ -121,27 +150,22 @@ class WeightedTVLoss(L1Loss):
 
     Args:
         loss_weight (float): Loss weight. Default: 1.0.
+        use_compile (bool): If True, run forward through torch.compile on CUDA. Default: True.
     """
 
-    def __init__(self, loss_weight=1.0, reduction='mean'):
+    def __init__(self, loss_weight=1.0, reduction='mean', use_compile=True):
         if reduction not in ['mean', 'sum']:
             raise ValueError(f'Unsupported reduction mode: {reduction}. Supported ones are: mean | sum')
-        super(WeightedTVLoss, self).__init__(loss_weight=loss_weight, reduction=reduction)
+        super(WeightedTVLoss, self).__init__(loss_weight=loss_weight, reduction=reduction, use_compile=use_compile)
 
+    @compile_for_cuda
     def forward(self, pred, weight=None):
-        if weight is None:
-            y_weight = None
-            x_weight = None
-        else:
-            y_weight = weight[:, :, :-1, :]
-            x_weight = weight[:, :, :, :-1]
-
-        y_diff = super().forward(pred[:, :, :-1, :], pred[:, :, 1:, :], weight=y_weight)
-        x_diff = super().forward(pred[:, :, :, :-1], pred[:, :, :, 1:], weight=x_weight)
-
-        loss = x_diff + y_diff
-
-        return loss
+        """
+        Args:
+            pred (Tensor): of shape (N, C, H, W). Predicted tensor.
+            weight (Tensor, optional): of shape (N, C, H, W). Element-wise weights. Default: None.
+        """
+        return self.loss_weight * weighted_tv_loss(pred, weight, reduction=self.reduction)
 
 
 @LOSS_REGISTRY.register()
@@ -163,6 +187,8 @@ class PerceptualLoss(nn.Module):
             loss will be calculated and the loss will multiplied by the
             weight. Default: 1.0.
         criterion (str): Criterion used for perceptual loss. Default: 'huber'.
+        use_amp (bool): If True, run the vgg forward and the criterion under
+            bfloat16 autocast on GPUs that support it. Default: True.
     """
 
     def __init__(
@@ -173,18 +199,26 @@ class PerceptualLoss(nn.Module):
         range_norm: bool = False,
         perceptual_weight: float = 1.0,
         criterion: str = "huber",
+        use_amp: bool = True,
         **kwargs,
     ) -> None:
         super(PerceptualLoss, self).__init__()
         self.perceptual_weight = perceptual_weight
         self.layer_weights = layer_weights
+        # layer weights in the order of self.layer_weights, kept on the loss device
+        self.register_buffer(
+            "_lw_tensor", torch.tensor(list(layer_weights.values()), dtype=torch.float32), persistent=False
+        )
+        self.use_amp = use_amp and torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        # side streams for the two vgg forwards, created lazily per device
+        self._streams = {}
 
         self.vgg = VGGFeatureExtractor(
             layer_name_list=list(layer_weights.keys()),
             vgg_type=vgg_type,
             use_input_norm=use_input_norm,
             range_norm=range_norm,
-        )
+        ).to(memory_format=torch.channels_last)
 
         self.criterion_type = criterion
         if self.criterion_type == "l1":
@@ -210,30 +244,71 @@ class PerceptualLoss(nn.Module):
         Returns:
             Tensor: Forward results.
         """
-        # extract vgg features
-        x_features = self.vgg(x)
-        gt_features = self.vgg(gt.detach())
-
-        # calculate perceptual loss
+        # conv layers pick faster NHWC kernels, especially under bf16 autocast
+        x = x.contiguous(memory_format=torch.channels_last)
+        gt = gt.contiguous(memory_format=torch.channels_last)
+
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=self.use_amp and x.is_cuda):
+            # extract vgg features
+            x_features, gt_features = self._extract_features(x, gt)
+
+            # calculate perceptual loss of each layer
+            if self.perceptual_weight > 0:
+                losses = []
+                for k in self.layer_weights.keys():
+                    if self.criterion_type == "fro":
+                        # note: linalg.norm uses Frobenius norm by default
+                        losses.append(torch.linalg.norm(x_features[k] - gt_features[k]))
+                    else:
+                        losses.append(self.criterion(x_features[k], gt_features[k]))
+
+        # weight the layers in a single dot product, in fp32 so that the loss
+        # stays in fp32 when it is summed with the other losses
         if self.perceptual_weight > 0:
-            percep_loss = 0
-            for k in x_features.keys():
-                if self.criterion_type == "fro":
-                    # note: linalg.norm uses Frobenius norm by default
-                    percep_loss += (
-                        torch.linalg.norm(x_features[k] - gt_features[k])
-                        * self.layer_weights[k]
-                    )
-                else:
-                    percep_loss += (
-                        self.criterion(x_features[k], gt_features[k])
-                        * self.layer_weights[k]
-                    )
-
-            percep_loss *= self.perceptual_weight
+            percep_loss = (torch.stack(losses).float() @ self._lw_tensor) * self.perceptual_weight
 
         return percep_loss
 
+    def _extract_features(self, x, gt):
+        """Extract vgg features of x and gt.
+
+        On CUDA the two independent forwards run on separate streams, so they
+        can overlap on the device.
+
+        Args:
+            x (Tensor): Input tensor with shape (n, c, h, w).
+            gt (Tensor): Ground-truth tensor with shape (n, c, h, w).
+
+        Returns:
+            tuple[dict, dict]: Features of x and gt.
+        """
+        if not x.is_cuda:
+            return self.vgg(x), self.vgg(gt.detach())
+
+        if x.device not in self._streams:
+            self._streams[x.device] = (torch.cuda.Stream(x.device), torch.cuda.Stream(x.device))
+        x_stream, gt_stream = self._streams[x.device]
+        current_stream = torch.cuda.current_stream(x.device)
+
+        # inputs were produced on the current stream
+        x_stream.wait_stream(current_stream)
+        gt_stream.wait_stream(current_stream)
+        x.record_stream(x_stream)
+        gt.record_stream(gt_stream)
+
+        with torch.cuda.stream(x_stream):
+            x_features = self.vgg(x)
+        with torch.cuda.stream(gt_stream):
+            gt_features = self.vgg(gt.detach())
+
+        # features are consumed on the current stream
+        current_stream.wait_stream(x_stream)
+        current_stream.wait_stream(gt_stream)
+        for feat in (*x_features.values(), *gt_features.values()):
+            feat.record_stream(current_stream)
+
+        return x_features, gt_features
+
     def _gram_mat(self, x):
         """Calculate Gram matrix.
 
@@ -260,6 +335,7 @@ class colorloss(nn.Module):
         avgpool (bool): apply downscaling after conversion. Default: False
         scale (int): value used by avgpool. Default: 4
         loss_weight (float): weight for colorloss. Default: 1.0
+        use_compile (bool): run forward through torch.compile on CUDA. Default: True
     """
 
     def __init__(
@@ -268,12 +344,21 @@ class colorloss(nn.Module):
         avgpool: bool = False,
         scale: int = 2,
         loss_weight: float = 1.0,
+        use_compile: bool = True,
     ) -> None:
         super(colorloss, self).__init__()
         self.loss_weight = loss_weight
         self.criterion_type = criterion
         self.avgpool = avgpool
         self.scale = scale
+        self.pool = nn.AvgPool2d(kernel_size=int(scale)) if avgpool else nn.Identity()
+        # Cb and Cr rows of the bt.601 matrix of rgb_to_cbcr, 0-1 normalization folded in
+        self.register_buffer(
+            "_m_cbcr",
+            torch.tensor([[-37.797, -74.203, 112.0], [112.0, -93.786, -18.214]]) / 255.0,
+            persistent=False,
+        )
+        self.register_buffer("_b_cbcr", torch.tensor([128.0, 128.0]) / 255.0, persistent=False)
 
         if self.criterion_type == "l1":
             self.criterion = nn.L1Loss()
@@ -284,13 +369,16 @@ class colorloss(nn.Module):
         else:
             raise NotImplementedError(f"{criterion} criterion has not been supported.")
 
-    def forward(self, input: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
-        input_uv = rgb_to_cbcr(input)
-        target_uv = rgb_to_cbcr(target)
+        self.use_compile = use_compile
 
-        if self.avgpool:
-            input_uv = torch.nn.AvgPool2d(kernel_size=int(self.scale))(input_uv)
-            target_uv = torch.nn.AvgPool2d(kernel_size=int(self.scale))(target_uv)
+    def _to_cbcr(self, x: torch.Tensor) -> torch.Tensor:
+        """Same as rgb_to_cbcr, as a single 1x1 conv with bias."""
+        return F.conv2d(x, self._m_cbcr.view(2, 3, 1, 1).to(x), self._b_cbcr.to(x))
+
+    @compile_for_cuda
+    def forward(self, input: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+        input_uv = self.pool(self._to_cbcr(input))
+        target_uv = self.pool(self._to_cbcr(target))
 
         return self.criterion(input_uv, target_uv) * self.loss_weight
 
@@ -299,7 +387,7 @@ class colorloss(nn.Module):
 class AverageLoss(nn.Module):
     """Averaging Downscale loss"""
 
-    def __init__(self, criterion='l1', loss_weight=1.0, scale=4):
+    def __init__(self, criterion='l1', loss_weight=1.0, scale=4, use_compile=True):
         super(AverageLoss, self).__init__()
         self.ds_f = torch.nn.AvgPool2d(kernel_size=int(scale))
         self.loss_weight = loss_weight
@@ -311,6 +399,9 @@ class AverageLoss(nn.Module):
         else:
             raise NotImplementedError(f'{criterion} criterion has not been supported.')
 
+        self.use_compile = use_compile
+
+    @compile_for_cuda
     def forward(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
         return self.criterion(self.ds_f(x), self.ds_f(y)) * self.loss_weight
 
@@ -343,6 +434,9 @@ class ContextualLoss(nn.Module):
 
     layer_weights: is a dict, e.g., {'conv1_1': 1.0, 'conv3_2': 1.0}
     crop_quarter: boolean
+    resample_every: int, number of forward calls the random pooling indices are reused for
+    debug: boolean, raise if the loss is not finite (syncs with the device every call)
+    use_compile: boolean, run the distance and similarity computations through torch.compile on CUDA
     """
 
     def __init__(self,
@@ -359,10 +453,14 @@ class ContextualLoss(nn.Module):
                  use_vgg: bool = True,
                  net: str = 'vgg19',
                  calc_type: str = 'regular',
-                 z_norm: bool = False):
+                 z_norm: bool = False,
+                 resample_every: int = 1,
+                 debug: bool = False,
+                 use_compile: bool = True):
         super(ContextualLoss, self).__init__()
 
         assert band_width > 0, 'band_width parameter must be positive.'
+        assert resample_every >= 1, 'resample_every parameter must be at least 1.'
         assert distance_type in DIS_TYPES,\
             f'select a distance type from {DIS_TYPES}.'
 
@@ -373,6 +471,9 @@ class ContextualLoss(nn.Module):
         else:
             listen_list = []
             self.layer_weights = {}
+        # layer weights in the order of self.layer_weights, kept on the loss device
+        self.register_buffer('_lw_tensor', torch.tensor(list(self.layer_weights.values()), dtype=torch.float32),
+                             persistent=False)
 
         self.loss_weight = loss_weight
         self.crop_quarter = crop_quarter
@@ -380,10 +481,19 @@ class ContextualLoss(nn.Module):
         self.max_1d_size = max_1d_size
         self.b = b
         self.band_width = band_width  # self.h = h, #sigma
+        self.resample_every = resample_every
+        self.debug = debug
+        self.use_compile = use_compile
+        # random pooling indices, keyed by (layer name, H*W, device) of the pooled features
+        self._sample_idx = {}
+        self._sample_step = 0
+        # spatial similarity of bilateral_CX_Loss for the last (H, W, device)
+        self._grid_cache = {}
 
         if use_vgg:
             self.vgg_model = VGGFeatureExtractor(
-                layer_name_list=listen_list, vgg_type=net, use_input_norm=z_norm, range_norm=z_norm)
+                layer_name_list=listen_list, vgg_type=net, use_input_norm=z_norm,
+                range_norm=z_norm).to(memory_format=torch.channels_last)
 
         if calc_type == 'bilateral':
             self.calculate_loss = self.bilateral_CX_Loss
@@ -393,17 +503,21 @@ class ContextualLoss(nn.Module):
             self.calculate_loss = self.calculate_CX_Loss
 
     def forward(self, images, gt):
-        device = images.device
+        if self._sample_step % self.resample_every == 0:
+            self._sample_idx.clear()
+        self._sample_step += 1
 
         if hasattr(self, 'vgg_model'):
             assert images.shape[1] == 3 and gt.shape[1] == 3,\
                 'VGG model takes 3 channel images.'
+            images = images.contiguous(memory_format=torch.channels_last)
+            gt = gt.contiguous(memory_format=torch.channels_last)
 
-            loss = 0
+            losses = []
+            # the extractor already returns fresh tensors on the input device,
+            # and the features are only replaced below, never modified in place
             vgg_images = self.vgg_model(images)
-            vgg_images = {k: v.clone().to(device) for k, v in vgg_images.items()}
             vgg_gt = self.vgg_model(gt)
-            vgg_gt = {k: v.to(device) for k, v in vgg_gt.items()}
 
             for key in self.layer_weights.keys():
                 if self.crop_quarter:
@@ -412,12 +526,16 @@ class ContextualLoss(nn.Module):
 
                 N, C, H, W = vgg_images[key].size()
                 if H * W > self.max_1d_size**2:
-                    vgg_images[key] = self._random_pooling(vgg_images[key], output_1d_size=self.max_1d_size)
-                    vgg_gt[key] = self._random_pooling(vgg_gt[key], output_1d_size=self.max_1d_size)
+                    vgg_images[key], vgg_gt[key] = self._random_pooling([vgg_images[key], vgg_gt[key]],
+                                                                        output_1d_size=self.max_1d_size,
+                                                                        name=key)
 
-                loss_t = self.calculate_loss(vgg_images[key], vgg_gt[key])
-                loss += loss_t * self.layer_weights[key]
+                losses.append(self.calculate_loss(vgg_images[key], vgg_gt[key]))
                 # del vgg_images[key], vgg_gt[key]
+
+            loss = 0
+            if losses:
+                loss = torch.stack(losses).float() @ self._lw_tensor
         # TODO: without VGG it runs, but results are not looking right
         else:
             if self.crop_quarter:
@@ -426,8 +544,7 @@ class ContextualLoss(nn.Module):
 
             N, C, H, W = images.size()
             if H * W > self.max_1d_size**2:
-                images = self._random_pooling(images, output_1d_size=self.max_1d_size)
-                gt = self._random_pooling(gt, output_1d_size=self.max_1d_size)
+                images, gt = self._random_pooling([images, gt], output_1d_size=self.max_1d_size)
 
             loss = self.calculate_loss(images, gt)
         return loss
@@ -437,25 +554,23 @@ class ContextualLoss(nn.Module):
         N, C, H, W = tensor.size()
         S = H * W
         tensor = tensor.view(N, C, S)
-        device = tensor.device
         if indices is None:
-            indices = torch.randperm(S)[:n].contiguous().type_as(tensor).long()
-            indices = indices.clamp(indices.min(), tensor.shape[-1] - 1)  # max = indices.max()-1
-            indices = indices.view(1, 1, -1).expand(N, C, -1)
-        indices = indices.to(device)
+            indices = torch.randperm(S, device=tensor.device)[:n]
 
-        res = torch.gather(tensor, index=indices, dim=-1)
+        res = torch.gather(tensor, index=indices.expand(N, C, -1), dim=-1)
         return res, indices
 
-    @staticmethod
-    def _random_pooling(feats, output_1d_size=100):
+    def _random_pooling(self, feats, output_1d_size=100, name=None):
         single_input = type(feats) is torch.Tensor
 
         if single_input:
             feats = [feats]
 
         N, C, H, W = feats[0].size()
-        feats_sample, indices = ContextualLoss._random_sampling(feats[0], output_1d_size**2, None)
+        key = (name, H * W, feats[0].device)
+        feats_sample, indices = ContextualLoss._random_sampling(feats[0], output_1d_size**2,
+                                                                self._sample_idx.get(key))
+        self._sample_idx[key] = indices
         res = [feats_sample]
 
         for i in range(1, len(feats)):
@@ -471,6 +586,11 @@ class ContextualLoss(nn.Module):
     @staticmethod
     def _crop_quarters(feature_tensor):
         N, fC, fH, fW = feature_tensor.size()
+        if fH % 2 == 0 and fW % 2 == 0:
+            # fold the 2x2 quarters into the batch dim with a single copy, same order as below
+            feature_tensor = feature_tensor.view(N, fC, 2, fH // 2, 2, fW // 2).permute(2, 4, 0, 1, 3, 5)
+            return feature_tensor.reshape(4 * N, fC, fH // 2, fW // 2)
+
         quarters_list = []
         quarters_list.append(feature_tensor[..., 0:round(fH / 2), 0:round(fW / 2)])
         quarters_list.append(feature_tensor[..., 0:round(fH / 2), round(fW / 2):])
@@ -481,6 +601,7 @@ class ContextualLoss(nn.Module):
         return feature_tensor
 
     @staticmethod
+    @compile_for_cuda
     def _create_using_L2(I_features, T_features):
         """
         Calculating the distance between each feature of I and T
@@ -496,19 +617,14 @@ class ContextualLoss(nn.Module):
 
         square_I = torch.sum(Ivecs * Ivecs, dim=1, keepdim=False)
         square_T = torch.sum(Tvecs * Tvecs, dim=1, keepdim=False)
-        # raw_distance
-        raw_distance = []
-        for i in range(N):
-            Ivec, Tvec, s_I, s_T = Ivecs[i, ...], Tvecs[i, ...], square_I[i, ...], square_T[i, ...]
-            # matrix multiplication
-            AB = Ivec.permute(1, 0) @ Tvec
-            dist = s_I.view(-1, 1) + s_T.view(1, -1) - 2 * AB
-            raw_distance.append(dist.view(1, H, W, H * W))
-        raw_distance = torch.cat(raw_distance, dim=0)
-        raw_distance = torch.clamp(raw_distance, 0.0)
+        # raw_distance, one batched matrix multiplication for the whole batch
+        AB = torch.bmm(Ivecs.transpose(1, 2), Tvecs)
+        raw_distance = square_I.unsqueeze(2) + square_T.unsqueeze(1) - 2 * AB
+        raw_distance = raw_distance.clamp_min_(0.0).view(N, H, W, H * W)
         return raw_distance
 
     @staticmethod
+    @compile_for_cuda
     def _create_using_L1(I_features, T_features):
         assert I_features.size() == T_features.size()
         N, C, H, W = I_features.size()
@@ -516,15 +632,12 @@ class ContextualLoss(nn.Module):
         Ivecs = I_features.view(N, C, -1)
         Tvecs = T_features.view(N, C, -1)
 
-        raw_distance = []
-        for i in range(N):
-            Ivec, Tvec = Ivecs[i, ...], Tvecs[i, ...]
-            dist = torch.sum(torch.abs(Ivec.view(C, -1, 1) - Tvec.view(C, 1, -1)), dim=0, keepdim=False)
-            raw_distance.append(dist.view(1, H, W, H * W))
-        raw_distance = torch.cat(raw_distance, dim=0)
+        raw_distance = torch.cdist(Ivecs.transpose(1, 2), Tvecs.transpose(1, 2), p=1)
+        raw_distance = raw_distance.view(N, H, W, H * W)
         return raw_distance
 
     @staticmethod
+    @compile_for_cuda
     def _create_using_dotP(I_features, T_features):
         assert I_features.size() == T_features.size()
         # prepare feature before calculating cosine distance
@@ -538,20 +651,11 @@ class ContextualLoss(nn.Module):
         T_features = F.normalize(T_features, p=2, dim=1)
 
         N, C, H, W = I_features.size()
-        cosine_dist = []
-        # work seperatly for each example in dim 1
-        for i in range(N):
-            # channel-wise vectorization
-            T_features_i = T_features[i].view(1, 1, C, H * W).permute(3, 2, 0,
-                                                                      1).contiguous()  # 1CHW --> 11CP, with P=H*W
-            I_features_i = I_features[i].unsqueeze(0)
-            dist = F.conv2d(I_features_i, T_features_i).permute(0, 2, 3, 1).contiguous()
-            # cosine_dist.append(dist) # back to 1CHW
-            # TODO: temporary hack to workaround AMP bug:
-            cosine_dist.append(dist.to(torch.float32))  # back to 1CHW
-        cosine_dist = torch.cat(cosine_dist, dim=0)
-        cosine_dist = (1 - cosine_dist) / 2
-        cosine_dist = cosine_dist.clamp(min=0.0)
+        # channel-wise vectorization, one batched matrix multiplication for the whole batch
+        I_vecs = I_features.view(N, C, -1).transpose(1, 2)
+        T_vecs = T_features.view(N, C, -1)
+        cosine_dist = torch.bmm(I_vecs, T_vecs).view(N, H, W, H * W)
+        cosine_dist = ((1 - cosine_dist) * 0.5).clamp_min_(0.0)
 
         return cosine_dist
 
@@ -568,105 +672,112 @@ class ContextualLoss(nn.Module):
         relative_dist = raw_distance / (div + epsilon)  # Eq 2
         return relative_dist
 
+    @staticmethod
+    @compile_for_cuda
+    def _calculate_contextual_sim(raw_distance, b, band_width):
+        """
+        Contextual similarity as Eq. (2)-(4) in paper, fused into one pass over each row on CUDA
+        :param raw_distance: [N, H, W, H*W]
+        :param b:
+        :param band_width: h>0, the band-width parameter
+        :return: contextual_sim: [N, H, W, H*W]
+        """
+        relative_distance = ContextualLoss._calculate_relative_distance(raw_distance)
+        exp_distance = torch.exp((b - relative_distance) / band_width)  # Eq(3)
+        contextual_sim = exp_distance / torch.sum(exp_distance, dim=-1, keepdim=True)  # Eq(4)
+        return contextual_sim
+
+    @staticmethod
+    @compile_for_cuda
+    def _calculate_max_contextual_sim(raw_distance, b, band_width):
+        """
+        Maximum contextual similarity of each T feature as Eq. (1) in paper. On CUDA the
+        similarity is reduced inside the fused kernel instead of being written out first
+        :param raw_distance: [N, H, W, H*W]
+        :param b:
+        :param band_width: h>0, the band-width parameter
+        :return: max_gt_sim: [N, H*W]
+        """
+        relative_distance = ContextualLoss._calculate_relative_distance(raw_distance).flatten(1, 2)
+        log_exp_distance = (b - relative_distance).div_(band_width)  # log of Eq(3)
+        # max(exp(x) / sum(exp(x))) == exp(max(x - logsumexp(x))), so the normalized
+        # similarity of Eq(4) never has to be materialized
+        log_sim = log_exp_distance - torch.logsumexp(log_exp_distance, dim=-1, keepdim=True)
+        max_gt_sim = torch.exp(torch.max(log_sim, dim=1)[0])  # Eq(1)
+        return max_gt_sim
+
+    def _op(self, fn):
+        """The compiled helper fn, or the eager function it wraps if use_compile is off"""
+        return fn if self.use_compile else fn.__wrapped__
+
     def symetric_CX_Loss(self, I_features, T_features):
         loss = (self.calculate_CX_Loss(T_features, I_features) + self.calculate_CX_Loss(I_features, T_features)) / 2
         return loss*self.loss_weight  # score
 
-    def bilateral_CX_Loss(self, I_features, T_features, weight_sp: float = 0.1):
-
-        def compute_meshgrid(shape):
-            N, C, H, W = shape
-            rows = torch.arange(0, H, dtype=torch.float32) / (H + 1)
-            cols = torch.arange(0, W, dtype=torch.float32) / (W + 1)
-
-            feature_grid = torch.meshgrid(rows, cols)
-            feature_grid = torch.stack(feature_grid).unsqueeze(0)
-            feature_grid = torch.cat([feature_grid for _ in range(N)], dim=0)
-
-            return feature_grid
+    def _spatial_contextual_sim(self, H, W, device):
+        """
+        Contextual similarity between the positions of a H x W feature map. It does not
+        depend on the features, so it is computed once per feature size and reused.
+        Only the last feature size is cached: the entry takes (H*W)^2 floats of device
+        memory, i.e. ~400 MB for the pooled 100 x 100 features of max_1d_size=100
+        :return: cx_sp: [1, H, W, H*W]
+        """
+        key = (H, W, device)
+        if key not in self._grid_cache:
+            self._grid_cache.clear()
+            rows = torch.arange(0, H, dtype=torch.float32, device=device) / (H + 1)
+            cols = torch.arange(0, W, dtype=torch.float32, device=device) / (W + 1)
+            grid = torch.stack(torch.meshgrid(rows, cols, indexing='ij')).unsqueeze(0)
+
+            raw_distance = self._op(ContextualLoss._create_using_L2)(grid, grid)  # calculate raw distance
+            self._grid_cache[key] = self._op(ContextualLoss._calculate_contextual_sim)(raw_distance, self.b,
+                                                                                       self.band_width)
+        return self._grid_cache[key]
 
-        # spatial loss
-        grid = compute_meshgrid(I_features.shape).to(T_features.device)
-        raw_distance = ContextualLoss._create_using_L2(grid, grid)  # calculate raw distance
-        dist_tilde = ContextualLoss._calculate_relative_distance(raw_distance)
-        exp_distance = torch.exp((self.b - dist_tilde) / self.band_width)  # Eq(3)
-        cx_sp = exp_distance / torch.sum(exp_distance, dim=-1, keepdim=True)  # Eq(4)
+    def bilateral_CX_Loss(self, I_features, T_features, weight_sp: float = 0.1):
+        # spatial loss, shared by all samples in the batch
+        cx_sp = self._spatial_contextual_sim(I_features.shape[2], I_features.shape[3], I_features.device)
 
         # feature loss
         # calculate raw distances
         if self.distanceType == 'l1':
-            raw_distance = ContextualLoss._create_using_L1(I_features, T_features)
+            raw_distance = self._op(ContextualLoss._create_using_L1)(I_features, T_features)
         elif self.distanceType == 'l2':
-            raw_distance = ContextualLoss._create_using_L2(I_features, T_features)
+            raw_distance = self._op(ContextualLoss._create_using_L2)(I_features, T_features)
         else:  # self.distanceType == 'cosine':
-            raw_distance = ContextualLoss._create_using_dotP(I_features, T_features)
-        dist_tilde = ContextualLoss._calculate_relative_distance(raw_distance)
-        exp_distance = torch.exp((self.b - dist_tilde) / self.band_width)  # Eq(3)
-        cx_feat = exp_distance / torch.sum(exp_distance, dim=-1, keepdim=True)  # Eq(4)
+            raw_distance = self._op(ContextualLoss._create_using_dotP)(I_features, T_features)
+        cx_feat = self._op(ContextualLoss._calculate_contextual_sim)(raw_distance, self.b, self.band_width)
 
         # combined loss
         cx_combine = (1. - weight_sp) * cx_feat + weight_sp * cx_sp
         k_max_NC, _ = torch.max(cx_combine, dim=2, keepdim=True)
         cx = k_max_NC.mean(dim=1)
         cx_loss = torch.mean(-torch.log(cx + 1e-5))
+        if self.debug and not torch.isfinite(cx_loss):
+            raise ValueError('NaN or Inf in computing CX_loss')
+
         return cx_loss*self.loss_weight
 
+    @compile_for_cuda
     def calculate_CX_Loss(self, I_features, T_features):
         device = I_features.device
         T_features = T_features.to(device)
 
-        if torch.sum(torch.isnan(I_features)) == torch.numel(I_features) or torch.sum(
-                torch.isinf(I_features)) == torch.numel(I_features):
-            print(I_features)
-            raise ValueError('NaN or Inf in I_features')
-        if torch.sum(torch.isnan(T_features)) == torch.numel(T_features) or torch.sum(
-                torch.isinf(T_features)) == torch.numel(T_features):
-            print(T_features)
-            raise ValueError('NaN or Inf in T_features')
-
         # calculate raw distances
         if self.distanceType == 'l1':
-            raw_distance = ContextualLoss._create_using_L1(I_features, T_features)
+            raw_distance = self._op(ContextualLoss._create_using_L1)(I_features, T_features)
         elif self.distanceType == 'l2':
-            raw_distance = ContextualLoss._create_using_L2(I_features, T_features)
+            raw_distance = self._op(ContextualLoss._create_using_L2)(I_features, T_features)
         else:  # self.distanceType == 'cosine':
-            raw_distance = ContextualLoss._create_using_dotP(I_features, T_features)
-        if torch.sum(torch.isnan(raw_distance)) == torch.numel(raw_distance) or torch.sum(
-                torch.isinf(raw_distance)) == torch.numel(raw_distance):
-            print(raw_distance)
-            raise ValueError('NaN or Inf in raw_distance')
+            raw_distance = self._op(ContextualLoss._create_using_dotP)(I_features, T_features)
 
-        # normalizing the distances
-        relative_distance = ContextualLoss._calculate_relative_distance(raw_distance)
-        if torch.sum(torch.isnan(relative_distance)) == torch.numel(relative_distance) or torch.sum(
-                torch.isinf(relative_distance)) == torch.numel(relative_distance):
-            print(relative_distance)
-            raise ValueError('NaN or Inf in relative_distance')
+        # normalizing the distances, similarity and its maximum over I
+        max_gt_sim = self._op(ContextualLoss._calculate_max_contextual_sim)(raw_distance, self.b, self.band_width)
         del raw_distance
 
-        # compute_sim()
-        # where h>0 is a band-width parameter
-        exp_distance = torch.exp((self.b - relative_distance) / self.band_width)  # Eq(3)
-        if torch.sum(torch.isnan(exp_distance)) == torch.numel(exp_distance) or torch.sum(
-                torch.isinf(exp_distance)) == torch.numel(exp_distance):
-            print(exp_distance)
-            raise ValueError('NaN or Inf in exp_distance')
-        del relative_distance
-
-        # Similarity
-        contextual_sim = exp_distance / torch.sum(exp_distance, dim=-1, keepdim=True)  # Eq(4)
-        if torch.sum(torch.isnan(contextual_sim)) == torch.numel(contextual_sim) or torch.sum(
-                torch.isinf(contextual_sim)) == torch.numel(contextual_sim):
-            print(contextual_sim)
-            raise ValueError('NaN or Inf in contextual_sim')
-        del exp_distance
-
-        # ContextualLoss()
-        max_gt_sim = torch.max(torch.max(contextual_sim, dim=1)[0], dim=1)[0]  # Eq(1)
-        del contextual_sim
         CS = torch.mean(max_gt_sim, dim=1)
         CX_loss = torch.mean(-torch.log(CS))  # Eq(5)
-        if torch.isnan(CX_loss):
-            raise ValueError('NaN in computing CX_loss')
+        if self.debug and not torch.isfinite(CX_loss):
+            raise ValueError('NaN or Inf in computing CX_loss')
 
         return CX_loss*self.loss_weight
@@ -2,6 +2,13 @@ import functools
 import torch
 from torch.nn import functional as F
 
+from ..utils import get_root_logger
+
+try:
+    from torch._dynamo.exc import BackendCompilerFailed
+except ImportError:  # torch < 2.0, without torch.compile; an empty tuple catches nothing
+    BackendCompilerFailed = ()
+
 
 def reduce_loss(loss, reduction):
     """Reduce loss as specified.
@@ -96,6 +103,59 @@ def weighted_loss(loss_func):
     return wrapper
 
 
+def compile_for_cuda(func):
+    """Run a loss function through ``torch.compile`` for CUDA inputs.
+
+    Losses are mostly chains of small memory-bound ops. On CUDA, Inductor
+    fuses such a chain (including the final reduction) into a single kernel,
+    so the full-size intermediates are never written back to memory.
+
+    CPU inputs and PyTorch builds without ``torch.compile`` run eagerly. If
+    ``torch.compile`` is not supported on the platform or Python version, or
+    a compilation fails (e.g. Triton is not available), a warning is logged
+    and the eager function is used from then on. Runtime errors of the
+    compiled function are raised as usual.
+
+    When decorating a method (e.g. a loss ``forward``), the instance can set
+    ``use_compile = False`` to always run it eagerly.
+
+    :Example:
+
+    >>> class L1Loss(nn.Module):
+    >>>     @compile_for_cuda
+    >>>     def forward(self, pred, target):
+    >>>         return (pred - target).abs().mean()
+    """
+    state = {'compiled': None, 'enabled': hasattr(torch, 'compile')}
+
+    def fall_back(e, *args, **kwargs):
+        state['enabled'] = False
+        logger = get_root_logger()
+        logger.warning(f'torch.compile failed for {func.__qualname__}, falling back to eager mode: {e}')
+        return func(*args, **kwargs)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        inputs = (*args, *kwargs.values())
+        if (not state['enabled'] or (args and not getattr(args[0], 'use_compile', True))
+                or not any(isinstance(a, torch.Tensor) and a.is_cuda for a in inputs)):
+            return func(*args, **kwargs)
+
+        if state['compiled'] is None:
+            try:
+                state['compiled'] = torch.compile(func)
+            except RuntimeError as e:
+                # dynamo is not supported here, e.g. on Windows or a too new Python
+                return fall_back(e, *args, **kwargs)
+        try:
+            return state['compiled'](*args, **kwargs)
+        except BackendCompilerFailed as e:
+            # raised while compiling a (re)traced graph, before it runs
+            return fall_back(e, *args, **kwargs)
+
+    return wrapper
+
+
 def get_local_weights(residual, ksize):
     """Get local weights for generating the artifact map of LDL.
 